@@ -5,13 +5,19 @@ Lightweight version without LangChain - preserves ALL functionality
 """
 import os
 import json
-import tempfile
+import orjson
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import Iterator, List, Dict, Optional
 import io
 
 # Google Drive API
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 
@@ -32,11 +38,28 @@ class GoogleDriveScanner:
         'text/plain': '.txt',
     }
     
+    # Concurrent Drive downloads (also caps downloaded files held in memory);
+    # override with GDRIVE_WORKERS
+    MAX_INFLIGHT_DOWNLOADS = 20
+    
+    # Files below this are fetched in a single GET; larger ones are chunked
+    SINGLE_SHOT_DOWNLOAD_BYTES = 10 * 1024 * 1024
+    DOWNLOAD_CHUNK_BYTES = 64 * 1024 * 1024
+    
+    # How often scan_drive checks for finished extractions while awaiting a download
+    DOWNLOAD_POLL_SECONDS = 0.05
+    
+    # PDFs longer than this are split into page ranges across the pool
+    PARALLEL_PDF_MIN_PAGES = 50
+    
     def __init__(self, credentials_json: str = None, folder_id: str = None):
         """Initialize with credentials JSON string or path"""
         self.credentials_json = credentials_json or os.getenv('GOOGLE_DRIVE_CREDENTIALS')
         self.folder_id = folder_id or os.getenv('GOOGLE_DRIVE_FOLDER_ID', '1m6wF8p340oSbRvt0s0zAGFh1l8VgC8wI')
         self.service = None
+        self.credentials = None
+        self._local = threading.local()
+        self.max_workers = int(os.getenv('GDRIVE_WORKERS', self.MAX_INFLIGHT_DOWNLOADS))
         
         if self.credentials_json:
             self._authenticate()
@@ -58,6 +81,7 @@ class GoogleDriveScanner:
                     scopes=['https://www.googleapis.com/auth/drive.readonly']
                 )
             
+            self.credentials = creds
             self.service = build('drive', 'v3', credentials=creds)
             print("✅ Authenticated with Google Drive")
             return True
@@ -65,6 +89,12 @@ class GoogleDriveScanner:
             print(f"❌ Authentication failed: {e}")
             return False
     
+    def _http(self):
+        """Per-thread authorized HTTP client (httplib2 is not thread-safe)"""
+        if not hasattr(self._local, 'http'):
+            self._local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return self._local.http
+    
     def parse_filename(self, filename: str) -> Dict:
         """Parse HCT naming convention: B_F5_AM_Aviation.pdf"""
         from pathlib import Path
@@ -104,137 +134,245 @@ class GoogleDriveScanner:
             print(f"❌ Error listing files: {e}")
             return []
     
-    def download_file(self, file_id: str, filename: str) -> Optional[str]:
-        """Download file from Google Drive to temp directory"""
+    def download_file(self, file_id: str, filename: str, size: Optional[int] = None) -> Optional[bytes]:
+        """Download file from Google Drive into memory"""
+        # Note: the Drive batch endpoint (multipart/mixed) does not accept
+        # media downloads (alt=media), so files can't be coalesced into one
+        # batch request. Latency is amortized by the download thread pool
+        # in scan_drive instead, and metadata already arrives in the single
+        # files().list() call.
         try:
             request = self.service.files().get_media(fileId=file_id)
-            temp_dir = tempfile.gettempdir()
-            temp_path = os.path.join(temp_dir, filename)
+            request.http = self._http()
+            
+            if size is not None and size < self.SINGLE_SHOT_DOWNLOAD_BYTES:
+                # Small file: one GET, no chunked round-trips
+                return request.execute()
             
-            with io.FileIO(temp_path, 'wb') as fh:
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while not done:
-                    status, done = downloader.next_chunk()
+            fh = io.BytesIO()
+            downloader = MediaIoBaseDownload(fh, request, chunksize=self.DOWNLOAD_CHUNK_BYTES)
+            done = False
+            while not done:
+                status, done = downloader.next_chunk()
             
-            return temp_path
+            return fh.getvalue()
         except Exception as e:
             print(f"   ❌ Download error: {e}")
             return None
     
-    def extract_text_from_pdf(self, file_path: str) -> str:
-        """Extract text from PDF using PyMuPDF"""
+    @staticmethod
+    def extract_text_from_pdf(data: bytes, start: int = 0, end: Optional[int] = None) -> str:
+        """Extract text from PDF using PyMuPDF (optionally pages[start:end])"""
         try:
-            doc = fitz.open(file_path)
-            text = ""
-            
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                text += page.get_text() + "\n"
-            
+            doc = fitz.open(stream=data, filetype='pdf')
+            end = doc.page_count if end is None else min(end, doc.page_count)
+            parts = [doc[i].get_text("text", sort=False) for i in range(start, end)]
             doc.close()
-            return text.strip()
+            return "\n".join(parts).strip()
         except Exception as e:
             print(f"   ⚠️ PDF error: {e}")
             return ""
     
-    def extract_text_from_docx(self, file_path: str) -> str:
+    @staticmethod
+    def pdf_page_ranges(data: bytes, parts: int) -> List[tuple]:
+        """Split a large PDF into page ranges, or [] if it isn't worth splitting"""
+        try:
+            doc = fitz.open(stream=data, filetype='pdf')
+            page_count = doc.page_count
+            doc.close()
+        except Exception:
+            return []
+        
+        if page_count <= GoogleDriveScanner.PARALLEL_PDF_MIN_PAGES or parts < 2:
+            return []
+        
+        step = -(-page_count // parts)
+        return [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    
+    @staticmethod
+    def extract_text_from_docx(data: bytes) -> str:
         """Extract text from Word document"""
         try:
-            doc = Document(file_path)
+            doc = Document(io.BytesIO(data))
             text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
             return text.strip()
         except Exception as e:
             print(f"   ⚠️ DOCX error: {e}")
             return ""
     
-    def extract_text_from_txt(self, file_path: str) -> str:
+    @staticmethod
+    def extract_text_from_txt(data: bytes) -> str:
         """Extract text from plain text file"""
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                return f.read().strip()
+            return data.decode('utf-8', errors='ignore').strip()
         except Exception as e:
             print(f"   ⚠️ TXT error: {e}")
             return ""
     
-    def extract_text(self, file_path: str, mime_type: str) -> str:
+    @staticmethod
+    def extract_text(data: bytes, mime_type: str) -> str:
         """Extract text based on file type"""
         if mime_type == 'application/pdf':
-            return self.extract_text_from_pdf(file_path)
+            return GoogleDriveScanner.extract_text_from_pdf(data)
         elif mime_type in ['application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/msword']:
-            return self.extract_text_from_docx(file_path)
+            return GoogleDriveScanner.extract_text_from_docx(data)
         elif mime_type == 'text/plain':
-            return self.extract_text_from_txt(file_path)
+            return GoogleDriveScanner.extract_text_from_txt(data)
         else:
             return ""
     
-    def scan_drive(self) -> List[Dict]:
-        """Scan Google Drive folder and extract all documents"""
+    def scan_drive(self) -> Iterator[Dict]:
+        """Scan Google Drive folder, yielding each document as it is extracted"""
         print(f"\n📂 Scanning Google Drive folder: {self.folder_id}")
         
         files = self.list_files()
         
         if not files:
             print("⚠️ No files found")
-            return []
+            return
         
-        documents = []
+        total_documents = 0
+        total_words = 0
         
-        for i, file_meta in enumerate(files, 1):
-            file_id = file_meta['id']
-            filename = file_meta['name']
-            mime_type = file_meta['mimeType']
-            
-            print(f"\n📄 [{i}/{len(files)}] {filename}")
-            
-            # Download file
-            file_path = self.download_file(file_id, filename)
-            if not file_path:
-                continue
-            
-            # Extract text
-            print(f"   📖 Extracting text...")
-            text = self.extract_text(file_path, mime_type)
+        # Cap downloaded files held in memory: a slot is taken before
+        # download and handed back once the file has been extracted
+        slots = threading.Semaphore(self.max_workers)
+        
+        def fetch(file_meta):
+            size = int(file_meta['size']) if 'size' in file_meta else None
+            data = self.download_file(file_meta['id'], file_meta['name'], size)
+            if data is None:
+                slots.release()
+            return data
+        
+        # Slots are taken here, on the consumer side and in listing order, so
+        # later files can never hold every slot while the next file in line
+        # waits for one. With block, waits for a slot if no download is queued
+        # (only extractions, which finish on their own, can be holding them)
+        to_download = deque(files)
+        futures = deque()
+        
+        def submit_downloads(block):
+            while to_download and slots.acquire(blocking=block and not futures):
+                futures.append(downloader.submit(fetch, to_download.popleft()))
+        
+        def release_after(job_count):
+            # Pool callbacks all run on the pool's single result-handler thread
+            remaining = [job_count]
             
-            if text:
-                word_count = len(text.split())
-                print(f"   ✅ Extracted {word_count:,} words")
+            def done(_):
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    slots.release()
+            return done
+        
+        # Extractions in listing order. Finished ones are yielded from the head
+        # while dispatch goes on; past max_workers waiting, the head is awaited
+        extracting = deque()
+        
+        def collect(drain):
+            nonlocal total_documents, total_words
+            while extracting and (drain or len(extracting) > self.max_workers or
+                                  all(part.ready() for part in extracting[0][1])):
+                # popleft drops the extracted text as soon as it is yielded
+                document = self._collect_document(*extracting.popleft())
+                if document:
+                    total_documents += 1
+                    total_words += document['word_count']
+                    yield document
+        
+        # Downloads (IO bound) run on threads and overlap with extraction
+        # (CPU bound - PyMuPDF holds the GIL) running on a process pool.
+        # Spawned, not forked: the scan also runs inside the threaded server,
+        # and a forked child can inherit locks held by other threads
+        workers = min(os.cpu_count() or 1, 4)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as downloader, \
+                multiprocessing.get_context('spawn').Pool(processes=workers) as pool:
+            for i, file_meta in enumerate(files, 1):
+                submit_downloads(block=True)
+                # popleft drops our reference so the bytes can be freed after extraction
+                future = futures.popleft()
+                # Hand out finished documents while this download is still running
+                while True:
+                    yield from collect(drain=False)
+                    submit_downloads(block=False)
+                    try:
+                        data = future.result(timeout=self.DOWNLOAD_POLL_SECONDS)
+                        break
+                    except FuturesTimeoutError:
+                        pass
+                print(f"\n📄 [{i}/{len(files)}] {file_meta['name']}")
+                if data is None:
+                    continue
                 
-                metadata = self.parse_filename(filename)
+                page_ranges = []
+                if file_meta['mimeType'] == 'application/pdf':
+                    page_ranges = self.pdf_page_ranges(data, workers)
                 
-                documents.append({
-                    'file_id': file_id,
-                    'filename': filename,
-                    'mime_type': mime_type,
-                    'category': metadata['category'],
-                    'product': metadata['product'],
-                    'subcategory': metadata['subcategory'],
-                    'topic': metadata['topic'],
-                    'content': text,
-                    'word_count': word_count,
-                    'scanned_at': datetime.now().isoformat(),
-                    'source': 'google_drive'
-                })
-            else:
-                print(f"   ⚠️ No text extracted")
+                if page_ranges:
+                    print(f"   📖 Extracting text ({len(page_ranges)} page ranges)...")
+                    done = release_after(len(page_ranges))
+                    pending = [
+                        pool.apply_async(_extract_pages, (data, start, end),
+                                         callback=done, error_callback=done)
+                        for start, end in page_ranges
+                    ]
+                else:
+                    print(f"   📖 Extracting text...")
+                    done = release_after(1)
+                    pending = [
+                        pool.apply_async(_extract_worker, (data, file_meta['mimeType']),
+                                         callback=done, error_callback=done)
+                    ]
+                del data
+                extracting.append((file_meta, pending))
+                
+                yield from collect(drain=False)
             
-            # Clean up temp file
-            try:
-                os.remove(file_path)
-            except:
-                pass
+            yield from collect(drain=True)
         
-        print(f"\n✅ Scan complete! {len(documents)} documents extracted")
-        total_words = sum(d['word_count'] for d in documents)
+        print(f"\n✅ Scan complete! {total_documents} documents extracted")
         print(f"📊 Total words: {total_words:,}")
+    
+    def _collect_document(self, file_meta: Dict, pending: List) -> Optional[Dict]:
+        """Wait for a file's extraction jobs and build its document (None if no text)"""
+        filename = file_meta['name']
+        
+        try:
+            text = "\n".join(part.get() for part in pending).strip()
+        except Exception as e:
+            print(f"   ⚠️ {filename}: extraction error: {e}")
+            text = ""
+        
+        if not text:
+            print(f"   ⚠️ {filename}: no text extracted")
+            return None
         
-        return documents
+        word_count = len(text.split())
+        print(f"   ✅ {filename}: {word_count:,} words")
+        
+        metadata = self.parse_filename(filename)
+        
+        return {
+            'file_id': file_meta['id'],
+            'filename': filename,
+            'mime_type': file_meta['mimeType'],
+            'category': metadata['category'],
+            'product': metadata['product'],
+            'subcategory': metadata['subcategory'],
+            'topic': metadata['topic'],
+            'content': text,
+            'word_count': word_count,
+            'scanned_at': datetime.now().isoformat(),
+            'source': 'google_drive'
+        }
     
     def save_index(self, documents: List[Dict], output_path: str = 'knowledge_index.json'):
         """Save extracted documents to JSON"""
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(documents, f, indent=2, ensure_ascii=False)
+            # orjson writes UTF-8 bytes directly (no ensure_ascii escaping)
+            with open(output_path, 'wb') as f:
+                f.write(orjson.dumps(documents, option=orjson.OPT_INDENT_2))
             
             file_size = os.path.getsize(output_path) / 1024
             print(f"\n💾 Saved: {output_path} ({file_size:.1f} KB)")
@@ -244,6 +382,16 @@ class GoogleDriveScanner:
             return False
 
 
+def _extract_worker(data: bytes, mime_type: str) -> str:
+    """Pool worker: module-level so it can be pickled"""
+    return GoogleDriveScanner.extract_text(data, mime_type)
+
+
+def _extract_pages(data: bytes, start: int, end: int) -> str:
+    """Pool worker: text of pages[start:end] of a large PDF"""
+    return GoogleDriveScanner.extract_text_from_pdf(data, start, end)
+
+
 # Command-line testing
 if __name__ == '__main__':
     print("=" * 70)
@@ -253,7 +401,7 @@ if __name__ == '__main__':
     scanner = GoogleDriveScanner()
     
     if scanner.service:
-        documents = scanner.scan_drive()
+        documents = list(scanner.scan_drive())
         
         if documents:
             scanner.save_index(documents)
@@ -0,0 +1,14 @@
+"""
+Gunicorn settings for production: gunicorn server:app
+Chat/TTS handlers mostly wait on OpenAI, so one worker runs a large
+thread pool (gthread) to keep many streams open at once. Sessions, the
+search index and the caches live in process memory, so a second worker
+would split chat history and miss /knowledge/refresh - scale with threads
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5002')}"
+worker_class = 'gthread'
+workers = 1
+threads = int(os.getenv('GUNICORN_THREADS', '50'))
+timeout = 60
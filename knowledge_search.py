@@ -1,76 +1,272 @@
 #!/usr/bin/env python3
 """
 HCT Knowledge Search Engine
-Fast full-text search using Whoosh
+Fast full-text search using SQLite FTS5
 """
 import os
 import json
-from whoosh import index
-from whoosh.fields import Schema, TEXT, ID, KEYWORD
-from whoosh.qparser import QueryParser, MultifieldParser
-from whoosh.analysis import StemmingAnalyzer
+import logging
+import sqlite3
+import threading
+import tempfile
+import functools
+import mmap
 import re
 
+logger = logging.getLogger('hct.search')
+
+# Full-text indexed columns (other metadata lives in docs only)
+SEARCH_FIELDS = ['product', 'content']
+
+# Columns free-text queries run against (product serves get_by_product)
+QUERY_FIELDS = ['content']
+
+# Common English stop words, ignored in queries
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'for', 'from',
+    'have', 'if', 'in', 'is', 'it', 'may', 'not', 'of', 'on', 'or', 'tbd',
+    'that', 'the', 'this', 'to', 'us', 'we', 'when', 'will', 'with', 'yet',
+    'you', 'your'
+])
+
+QUERY_TERM_RE = re.compile(r'\w+(?:-\w+)*')
+
+# Words recorded in the per-document position table
+WORD_RE = re.compile(r'\w+')
+
+# Product name variations (applied to the lowercased query, in order)
+QUERY_NORMALIZATIONS = (
+    # F-500 variations
+    (re.compile(r'\bf\s*500\b'), 'f-500'),
+    (re.compile(r'\bf500\b'), 'f-500'),
+    # HydroLock variations
+    (re.compile(r'\bhydro\s*lock\b'), 'hydrolock'),
+    # Pinnacle variations
+    (re.compile(r'\bpinnacle\s*foam\b'), 'pinnacle'),
+    # Dust Wash variations
+    (re.compile(r'\bdust\s*wash\b'), 'dust-wash'),
+)
+
+# SQLite page cache used while building the index (MB)
+INDEX_BUILD_CACHE_MB = int(os.getenv('SEARCH_INDEX_CACHE_MB', '512'))
+
+# Stored per document and used when no query word occurs in the body
+LEAD_SNIPPET_CHARS = 600
+
+# SQLite memory-maps up to this much of the index file
+INDEX_MMAP_BYTES = 256 * 1024 * 1024
+
+# Distinct queries kept in the search result cache
+SEARCH_CACHE_SIZE = 512
+
 class KnowledgeSearch:
-    def __init__(self, index_dir='whoosh_index'):
+    def __init__(self, index_dir='search_index'):
         self.index_dir = index_dir
-        self.schema = Schema(
-            filename=ID(stored=True),
-            path=TEXT(stored=True),
-            category=KEYWORD(stored=True, commas=True),
-            product=KEYWORD(stored=True, commas=True),
-            subcategory=KEYWORD(stored=True, commas=True),
-            topic=TEXT(stored=True, analyzer=StemmingAnalyzer()),
-            content=TEXT(stored=True, analyzer=StemmingAnalyzer())
-        )
+        self.index_path = os.path.join(index_dir, 'knowledge.db')
+        self.content_path = os.path.join(index_dir, 'content.bin')
         self.ix = None
+        self._content = b''
+        self._doc_count = 0
+        # Bumped on every index swap; part of the search cache key, so a
+        # search that read the old index can't cache over the new one
+        self._generation = 0
+        self._lock = threading.Lock()
+        # Serializes whole rebuilds (_lock only covers the final swap)
+        self._build_lock = threading.Lock()
+        
+        # Per-instance LRU of (normalized_query, max_results, generation) -> results
+        self._search_cached = functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)(self._run_search)
+    
+    def _connect(self):
+        """
+        Open the index database. One long-lived connection is shared by all
+        request threads (guarded by _lock), so queries never pay an open.
+        """
+        conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        # Read index pages through a memory map instead of read() calls
+        conn.execute(f"PRAGMA mmap_size = {INDEX_MMAP_BYTES}")
+        self._create_tables(conn)
+        return conn
+    
+    def _create_tables(self, conn):
+        """
+        docs: stored metadata, lead snippet + (offset, length) of the body in content.bin
+        documents: contentless FTS5 index over the searchable fields
+        positions: first byte offset of every word in each body (for snippets)
+        """
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                filename TEXT, path TEXT, category TEXT, product TEXT,
+                subcategory TEXT, topic TEXT, snippet TEXT,
+                content_offset INTEGER, content_length INTEGER
+            )
+        """)
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+                {', '.join(SEARCH_FIELDS)},
+                content='',
+                tokenize='porter unicode61'
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS positions (
+                doc_id INTEGER, word TEXT, first_offset INTEGER,
+                PRIMARY KEY (doc_id, word)
+            ) WITHOUT ROWID
+        """)
+    
+    def _close_content(self):
+        """Release the mapping (must happen before content.bin is replaced)"""
+        if isinstance(self._content, mmap.mmap):
+            self._content.close()
+        self._content = b''
+    
+    def _open_content(self):
+        """Memory-map content.bin (bodies are sliced out only when needed)"""
+        self._close_content()
+        
+        if os.path.exists(self.content_path) and os.path.getsize(self.content_path):
+            with open(self.content_path, 'rb') as f:
+                self._content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def _read_content(self, offset, length):
+        """Decode one document body from the mapped content file"""
+        return self._content[offset:offset + length].decode('utf-8')
         
     def create_index(self, documents):
         """
-        Create Whoosh index from scanned documents
-        documents: list of dicts from document_scanner
+        Create search index from scanned documents
+        documents: any iterable of dicts from a scanner (consumed in one pass)
+        Returns {'total_documents': ..., 'total_words': ...}
         """
+        with self._build_lock:
+            return self._build_index(documents)
+    
+    def _build_index(self, documents):
+        """Build and swap in a new index (call with _build_lock held)"""
         print(f"\n🔨 Building search index...")
         
         # Create index directory
         if not os.path.exists(self.index_dir):
             os.makedirs(self.index_dir)
-            self.ix = index.create_in(self.index_dir, self.schema)
             print(f"   ✅ Created new index: {self.index_dir}")
-        else:
-            # Open existing or create new
-            try:
-                self.ix = index.open_dir(self.index_dir)
-                print(f"   ✅ Opened existing index")
-            except:
-                self.ix = index.create_in(self.index_dir, self.schema)
-                print(f"   ✅ Created new index")
         
-        # Index all documents
-        writer = self.ix.writer()
+        # Build into side files so searches keep running on the old index
+        # (documents may be a generator that is still scanning)
+        index_fd, index_tmp = tempfile.mkstemp(dir=self.index_dir, suffix='.db.tmp')
+        os.close(index_fd)
+        content_fd, content_tmp = tempfile.mkstemp(dir=self.index_dir, suffix='.bin.tmp')
         
-        for i, doc in enumerate(documents):
-            writer.add_document(
-                filename=doc['filename'],
-                path=doc.get('path', ''),
-                category=doc['category'],
-                product=doc['product'],
-                subcategory=doc['subcategory'],
-                topic=doc['topic'],
-                content=doc['content']
-            )
+        stats = {'total_documents': 0, 'total_words': 0}
+        try:
+            with os.fdopen(content_fd, 'wb') as content_file:
+                conn = sqlite3.connect(index_tmp)
+                try:
+                    # Bigger page cache while bulk loading (KiB when negative)
+                    conn.execute(f"PRAGMA cache_size = -{INDEX_BUILD_CACHE_MB * 1024}")
+                    self._create_tables(conn)
+                    
+                    with conn:
+                        # One prepared statement for the whole batch
+                        conn.executemany(
+                            f"INSERT INTO documents (rowid, {', '.join(SEARCH_FIELDS)}) VALUES (?, ?, ?)",
+                            self._index_rows(conn, documents, content_file, stats)
+                        )
+                        # Merge all FTS segments into one b-tree for faster queries
+                        conn.execute("INSERT INTO documents (documents) VALUES ('optimize')")
+                finally:
+                    conn.close()
             
-            if (i + 1) % 10 == 0:
-                print(f"   📝 Indexed {i + 1}/{len(documents)} documents")
+            # Swap the new index in
+            with self._lock:
+                if self.ix:
+                    self.ix.close()
+                self._close_content()
+                os.replace(index_tmp, self.index_path)
+                os.replace(content_tmp, self.content_path)
+                
+                self.ix = self._connect()
+                self._open_content()
+                self._count_documents()
+                self._new_generation()
+        finally:
+            # Left behind only if the build failed before the swap
+            for path in (index_tmp, content_tmp):
+                if os.path.exists(path):
+                    os.remove(path)
         
-        writer.commit()
-        print(f"   ✅ Index complete: {len(documents)} documents")
+        print(f"   ✅ Index complete: {stats['total_documents']} documents")
+        return stats
         
+    def _index_rows(self, conn, documents, content_file, stats):
+        """
+        Yield one FTS row per document, logging every 50.
+        Bodies are appended to content_file; metadata and (doc, word, first
+        byte offset) rows are written as each document streams past.
+        """
+        offset = 0
+        for i, doc in enumerate(documents):
+            body = doc['content'].encode('utf-8')
+            content_file.write(body)
+            
+            conn.execute(
+                "INSERT INTO docs (id, filename, path, category, product, subcategory, topic, "
+                "snippet, content_offset, content_length) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    i,
+                    doc['filename'],
+                    doc.get('path', ''),
+                    doc['category'],
+                    doc['product'],
+                    doc['subcategory'],
+                    doc['topic'],
+                    doc['content'][:LEAD_SNIPPET_CHARS].strip(),
+                    offset,
+                    len(body)
+                )
+            )
+            offset += len(body)
+            
+            # Byte offsets, so snippets can be cut from content.bin directly
+            text = doc['content']
+            first_offsets = {}
+            char_pos = byte_pos = 0
+            for word in WORD_RE.finditer(text):
+                key = word.group().lower()
+                if key not in first_offsets:
+                    byte_pos += len(text[char_pos:word.start()].encode('utf-8'))
+                    char_pos = word.start()
+                    first_offsets[key] = byte_pos
+            conn.executemany(
+                "INSERT INTO positions (doc_id, word, first_offset) VALUES (?, ?, ?)",
+                ((i, word, pos) for word, pos in first_offsets.items())
+            )
+            
+            yield (
+                i,
+                doc['product'],
+                doc['content']
+            )
+            
+            stats['total_documents'] += 1
+            stats['total_words'] += doc.get('word_count', 0)
+            
+            if (i + 1) % 50 == 0:
+                print(f"   📝 Indexed {i + 1} documents")
+    
     def load_index(self):
-        """Load existing index"""
-        if os.path.exists(self.index_dir):
+        """Load existing index (replacing any open connection)"""
+        if os.path.exists(self.index_path):
             try:
-                self.ix = index.open_dir(self.index_dir)
+                with self._lock:
+                    if self.ix:
+                        self.ix.close()
+                        self.ix = None
+                    self.ix = self._connect()
+                    self._open_content()
+                    self._count_documents()
+                    self._new_generation()
                 print(f"✅ Search index loaded")
                 return True
             except Exception as e:
@@ -80,6 +276,39 @@ class KnowledgeSearch:
             print(f"⚠️  No index found at {self.index_dir}")
             return False
     
+    def _ensure_index(self):
+        """Load the index on first use; concurrent first requests load it once"""
+        if self.ix:
+            return True
+        
+        # Also waits out a build in progress, which installs its own index
+        with self._build_lock:
+            return bool(self.ix) or self.load_index()
+    
+    def _count_documents(self):
+        """Refresh the cached document count (call with _lock held)"""
+        self._doc_count = self.ix.execute("SELECT count(*) FROM docs").fetchone()[0]
+    
+    def _new_generation(self):
+        """Start a new cache generation after a swap or load (call with _lock held)"""
+        self._generation += 1
+        self._search_cached.cache_clear()
+    
+    def doc_count(self):
+        """Number of indexed documents (cached; updated on create/load)"""
+        return self._doc_count
+    
+    def match_expression(self, normalized_query):
+        """
+        Turn a normalized query into an FTS5 MATCH expression:
+        every remaining term quoted (so 'f-500' is a phrase, not syntax), ANDed
+        """
+        terms = [
+            term for term in QUERY_TERM_RE.findall(normalized_query)
+            if term not in STOP_WORDS and len(term) > 1
+        ]
+        return ' '.join(f'"{term}"' for term in terms)
+    
     def normalize_query(self, query):
         """
         Normalize common HCT product names
@@ -87,18 +316,8 @@ class KnowledgeSearch:
         """
         normalized = query.lower()
         
-        # F-500 variations
-        normalized = re.sub(r'\bf\s*500\b', 'f-500', normalized)
-        normalized = re.sub(r'\bf500\b', 'f-500', normalized)
-        
-        # HydroLock variations
-        normalized = re.sub(r'\bhydro\s*lock\b', 'hydrolock', normalized)
-        
-        # Pinnacle variations
-        normalized = re.sub(r'\bpinnacle\s*foam\b', 'pinnacle', normalized)
-        
-        # Dust Wash variations
-        normalized = re.sub(r'\bdust\s*wash\b', 'dust-wash', normalized)
+        for pattern, replacement in QUERY_NORMALIZATIONS:
+            normalized = pattern.sub(replacement, normalized)
         
         return normalized
     
@@ -107,110 +326,163 @@ class KnowledgeSearch:
         Search for documents matching query
         Returns list of results with relevance scores
         """
-        if not self.ix:
-            if not self.load_index():
-                return []
+        if not self._ensure_index():
+            return []
         
         # Normalize query
         normalized_query = self.normalize_query(query_text)
         
-        print(f"\n🔍 Searching: '{query_text}'")
+        logger.debug("🔍 Searching: %r", query_text)
         if normalized_query != query_text.lower():
-            print(f"   📝 Normalized: '{normalized_query}'")
+            logger.debug("   📝 Normalized: %r", normalized_query)
         
+        results = self._search_cached(normalized_query, max_results, self._generation)
+        
+        # Hand out copies so callers can't alter cached results
+        return [dict(result) for result in results]
+    
+    def _run_search(self, normalized_query, max_results, generation):
+        """
+        Run a normalized query against the index (cached by search;
+        generation only keys the cache)
+        """
         results_list = []
         
-        with self.ix.searcher() as searcher:
-            # Search across multiple fields
-            parser = MultifieldParser(
-                ['product', 'topic', 'content', 'category', 'subcategory'],
-                schema=self.ix.schema
-            )
+        match = self.match_expression(normalized_query)
+        if not match:
+            return tuple(results_list)
+        
+        # One lock hold for hits and snippets: offsets from the database must
+        # be sliced from the content file of the same build
+        with self._lock:
+            rows = self.ix.execute(
+                "SELECT docs.id, -documents.rank, docs.filename, docs.path, docs.category, docs.product, "
+                "docs.subcategory, docs.topic, docs.snippet, docs.content_offset, docs.content_length "
+                "FROM documents JOIN docs ON docs.id = documents.rowid "
+                "WHERE documents MATCH ? ORDER BY documents.rank LIMIT ?",
+                (f"{{{' '.join(QUERY_FIELDS)}}} : ({match})", max_results)
+            ).fetchall()
             
-            query = parser.parse(normalized_query)
-            results = searcher.search(query, limit=max_results)
+            # Snippet from the index - the body itself is never decoded
+            snippets = [
+                self.indexed_snippet(row[0], normalized_query, *row[-3:])
+                for row in rows
+            ]
+        
+        logger.debug("   ✅ Found %d results", len(rows))
+        
+        for i, ((doc_id, score, filename, path, category, product, subcategory, topic,
+                 lead_snippet, content_offset, content_length), snippet) in enumerate(zip(rows, snippets)):
+            result = {
+                'rank': i + 1,
+                'score': score,
+                'filename': filename,
+                'path': path,
+                'category': category,
+                'product': product,
+                'subcategory': subcategory or '',
+                'topic': topic,
+                'snippet': snippet
+            }
             
-            print(f"   ✅ Found {len(results)} results")
+            results_list.append(result)
             
-            for i, hit in enumerate(results):
-                # Extract relevant snippet from content
-                snippet = self.get_snippet(hit['content'], normalized_query)
-                
-                result = {
-                    'rank': i + 1,
-                    'score': hit.score,
-                    'filename': hit['filename'],
-                    'path': hit['path'],
-                    'category': hit['category'],
-                    'product': hit['product'],
-                    'subcategory': hit.get('subcategory', ''),
-                    'topic': hit['topic'],
-                    'snippet': snippet,
-                    'full_content': hit['content']
-                }
-                
-                results_list.append(result)
-                
-                print(f"\n   [{i+1}] {hit['filename']}")
-                print(f"       Score: {hit.score:.2f}")
-                print(f"       Product: {hit['product']}")
-                print(f"       Snippet: {snippet[:100]}...")
+            logger.debug("   [%d] %s (Score: %.2f, Product: %s) %s...",
+                         i + 1, filename, score, product, snippet[:100])
         
-        return results_list
+        return tuple(results_list)
     
-    def get_snippet(self, content, query, snippet_length=300):
+    def first_position(self, doc_id, words):
         """
-        Extract relevant snippet from content based on query
+        Earliest byte offset of any of the words in an indexed document
+        (or None). Call with _lock held.
         """
-        # Find first occurrence of any query term
-        query_terms = query.lower().split()
-        content_lower = content.lower()
+        if not words or not self.ix:
+            return None
         
-        earliest_pos = len(content)
-        for term in query_terms:
-            pos = content_lower.find(term)
-            if pos != -1 and pos < earliest_pos:
-                earliest_pos = pos
+        placeholders = ', '.join('?' * len(words))
+        row = self.ix.execute(
+            f"SELECT min(first_offset) FROM positions WHERE doc_id = ? AND word IN ({placeholders})",
+            (doc_id, *words)
+        ).fetchone()
+        return row[0]
+    
+    def indexed_snippet(self, doc_id, query, lead_snippet, content_offset, content_length,
+                        snippet_length=300):
+        """
+        Snippet for an indexed document: the window around the first query
+        word (position table) is sliced from content.bin, or the lead snippet
+        stored at index time is used when no query word occurs.
+        Call with _lock held, so the offsets and content.bin match.
+        """
+        # Tokenized like the position table, so 'f-500' looks up 'f' and '500'
+        query_terms = [
+            term for term in WORD_RE.findall(query.lower())
+            if term not in STOP_WORDS
+        ]
+        earliest_pos = self.first_position(doc_id, query_terms)
         
-        if earliest_pos == len(content):
-            # No match found, return beginning
-            return content[:snippet_length].strip()
+        if earliest_pos is None:
+            return lead_snippet
         
-        # Extract snippet around match
         start = max(0, earliest_pos - 100)
-        end = min(len(content), earliest_pos + snippet_length)
+        end = min(content_length, earliest_pos + snippet_length)
+        
+        window = self._content[content_offset + start:content_offset + end]
         
-        snippet = content[start:end].strip()
+        # Window edges may split a multi-byte character
+        snippet = window.decode('utf-8', errors='ignore').strip()
         
-        # Add ellipsis if truncated
         if start > 0:
             snippet = "..." + snippet
-        if end < len(content):
+        if end < content_length:
             snippet = snippet + "..."
         
         return snippet
     
+    def get_full_content(self, filename):
+        """Full text of an indexed document (search results carry only snippets)"""
+        if not self._ensure_index():
+            return ""
+        
+        with self._lock:
+            row = self.ix.execute(
+                "SELECT content_offset, content_length FROM docs WHERE filename = ?",
+                (filename,)
+            ).fetchone()
+            return self._read_content(*row) if row else ""
+    
     def get_by_product(self, product_name, max_results=10):
         """Get all documents for a specific product"""
-        if not self.ix:
-            if not self.load_index():
-                return []
+        if not self._ensure_index():
+            return []
         
         results_list = []
         
-        with self.ix.searcher() as searcher:
-            parser = QueryParser('product', schema=self.ix.schema)
-            query = parser.parse(product_name.lower())
-            results = searcher.search(query, limit=max_results)
-            
-            for hit in results:
-                results_list.append({
-                    'filename': hit['filename'],
-                    'path': hit['path'],
-                    'category': hit['category'],
-                    'topic': hit['topic'],
-                    'content': hit['content']
-                })
+        match = self.match_expression(product_name.lower())
+        if not match:
+            return results_list
+        
+        with self._lock:
+            rows = [
+                row[:-2] + (self._read_content(*row[-2:]),)
+                for row in self.ix.execute(
+                    "SELECT docs.filename, docs.path, docs.category, docs.topic, "
+                    "docs.content_offset, docs.content_length "
+                    "FROM documents JOIN docs ON docs.id = documents.rowid "
+                    "WHERE documents MATCH ? ORDER BY documents.rank LIMIT ?",
+                    (f"product : ({match})", max_results)
+                )
+            ]
+        
+        for filename, path, category, topic, content in rows:
+            results_list.append({
+                'filename': filename,
+                'path': path,
+                'category': category,
+                'topic': topic,
+                'content': content
+            })
         
         return results_list
 
@@ -219,6 +491,8 @@ class KnowledgeSearch:
 if __name__ == '__main__':
     import sys
     
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+    
     search_engine = KnowledgeSearch()
     
     # Load index
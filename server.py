@@ -1,26 +1,88 @@
-from flask import Flask, request, jsonify, send_from_directory, Response, send_file
+from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
+from flask_compress import Compress
 import os
+import time
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
-from openai import OpenAI
-import json
-import requests
-from bs4 import BeautifulSoup
-from io import BytesIO
+from openai import OpenAI, DefaultHttpxClient
+import orjson
+import re
+import httpx
+from selectolax.parser import HTMLParser
 
 # Import Google Drive knowledge search
 from knowledge_search import KnowledgeSearch
 
 load_dotenv()
 
+# Request-path logging: handlers only enqueue records, a background listener
+# thread does the console IO so streaming responses never block on stdout.
+# Default WARNING; set LOG_LEVEL=INFO (or DEBUG) to see per-request lines.
+logger = logging.getLogger('hct')
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING').upper())
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+
 app = Flask(__name__, static_folder='.', static_url_path='')
 CORS(app)
 
-# Initialize OpenAI
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Compress JSON and static text responses. SSE chat and MP3 audio are not
+# listed, so each chunk reaches the client immediately
+app.config.update(
+    COMPRESS_MIMETYPES=['application/json', 'text/html', 'text/css',
+                        'text/javascript', 'application/javascript', 'text/plain'],
+    COMPRESS_MIN_SIZE=200,
+)
+Compress(app)
+
+# Keep-alive pool size shared by the outbound HTTP clients
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32)
+
+# Initialize OpenAI once, on a pooled HTTP/2 connection reused by every request
+client = OpenAI(
+    api_key=os.getenv('OPENAI_API_KEY'),
+    http_client=DefaultHttpxClient(http2=True, limits=HTTP_LIMITS)
+)
 
 # Initialize Knowledge Search (works with both local and Drive-sourced indexes)
-knowledge_search = KnowledgeSearch('whoosh_index')
+knowledge_search = KnowledgeSearch('search_index')
+
+# Shared HTTP client: keep-alive + HTTP/2 so repeat scrapes skip the TLS handshake
+http_client = httpx.Client(
+    http2=True,
+    timeout=5.0,
+    limits=HTTP_LIMITS,
+    follow_redirects=True,
+    headers={'User-Agent': 'Mozilla/5.0'}
+)
+
+# Background threads for per-request IO (knowledge search, web scrape).
+# A chat turn submits up to two jobs, so size for every request thread
+# (gunicorn.conf.py) at once - slow page fetches must not queue searches
+io_pool = ThreadPoolExecutor(max_workers=2 * int(os.getenv('GUNICORN_THREADS', '50')))
+
+# Longest a chat turn waits on either context source before answering without it
+CONTEXT_TIMEOUT = 2.0
+
+# Leave the website text out when the top knowledge base hit scores at least
+# this. Scores are FTS5 bm25 (-rank): each matched term adds about
+# log((N - n + 0.5) / (n + 0.5)) * 2.2 at most, for n of N documents holding
+# it, so terms found in most documents add ~0 and a term in one of ~30
+# documents adds up to ~6.5. 3.0 takes a term in ~10% of documents, repeated
+WEB_SKIP_SCORE = float(os.getenv('WEB_SKIP_SCORE', '3.0'))
 
 # HCT Website URLs
 HCT_URLS = {
@@ -32,25 +94,47 @@ HCT_URLS = {
     'diamond doser': 'https://hct-world.com/diamond-doser',
 }
 
+# All URL keywords in one alternation, longest first, so a single scan of
+# the message finds the earliest keyword (and the longest one at that spot);
+# IGNORECASE spares lowercasing a copy of every message
+HCT_URL_KEYS = re.compile('|'.join(map(re.escape, sorted(HCT_URLS, key=len, reverse=True))),
+                          re.IGNORECASE)
+
+# Website pages change rarely - keep scraped text for 15 minutes
+PAGE_CACHE_TTL = 900
+PAGE_CACHE_SIZE = 32
+page_cache = {}  # url -> (expires_at, text)
+page_cache_lock = threading.Lock()
+
 # Fetch from website
 def fetch_hct_page(url):
-    """Fetch content from HCT website"""
+    """Fetch content from HCT website (cached)"""
+    with page_cache_lock:
+        cached = page_cache.get(url)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+    
     try:
-        print(f"🌐 Fetching: {url}")
-        response = requests.get(url, timeout=5, headers={
-            'User-Agent': 'Mozilla/5.0'
-        })
+        logger.debug("🌐 Fetching: %s", url)
+        response = http_client.get(url)
         
         if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            for script in soup(['script', 'style', 'nav', 'footer']):
-                script.decompose()
-            text = soup.get_text(separator=' ', strip=True)
-            text = ' '.join(text.split())
-            print(f"✅ Got {len(text)} chars from web")
-            return text[:1000]
+            tree = HTMLParser(response.text)
+            for node in tree.css('script, style, nav, footer'):
+                node.decompose()
+            root = tree.body or tree.root
+            text = ' '.join(root.text(separator=' ').split()) if root else ''
+            logger.debug("✅ Got %d chars from web", len(text))
+            text = text[:1000]
+            
+            with page_cache_lock:
+                if url not in page_cache and len(page_cache) >= PAGE_CACHE_SIZE:
+                    # Evict the entry closest to expiry
+                    del page_cache[min(page_cache, key=lambda k: page_cache[k][0])]
+                page_cache[url] = (time.monotonic() + PAGE_CACHE_TTL, text)
+            return text
     except Exception as e:
-        print(f"⚠️ Scrape error: {e}")
+        logger.warning("⚠️ Scrape error: %s", e)
     return ""
 
 # Basic knowledge (fallback)
@@ -60,7 +144,54 @@ Pinnacle: PFAS-free Class A foam.
 Dust Wash: Combustible dust control.
 Diamond Doser: Proportioning system for HCT products."""
 
-sessions = {}
+# Static parts of the system prompt, built once; per request only the
+# knowledge base / website context is joined in between
+SYSTEM_PROMPT_HEAD = f"""You are the HCT Voice Agent, a knowledgeable and conversational expert on Hazard Control Technologies products and fire suppression solutions.
+
+RESPONSE STYLE:
+- Provide comprehensive answers of 6-7 sentences that fully explain the topic
+- Be conversational and professional, never say "I don't have that in my knowledge base"
+- If you don't have specific information, provide related helpful information about HCT products and offer to help with related topics
+- Occasionally (about 30% of the time) ask a relevant follow-up question to engage the user, especially when:
+  * The user asks a broad question that could be narrowed down
+  * There are multiple product options that might fit their needs
+  * You want to understand their specific use case better
+- Don't ask follow-up questions when the user asks a very specific factual question that you fully answered
+
+KNOWLEDGE SOURCES (use these when available):
+{KNOWLEDGE}
+"""
+
+SYSTEM_PROMPT_TAIL = """
+
+Remember: Be helpful, detailed, and conversational. Focus on providing value even if you don't have the exact information requested."""
+
+# Conversation history: last 4 messages per session, at most 10k sessions
+# (least recently used sessions are evicted)
+MAX_SESSIONS = 10000
+SESSION_HISTORY = 4
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
+
+def get_session(session_id):
+    """History deque for a session (created on first use)"""
+    with sessions_lock:
+        history = sessions.get(session_id)
+        if history is None:
+            history = sessions[session_id] = deque(maxlen=SESSION_HISTORY)
+            if len(sessions) > MAX_SESSIONS:
+                sessions.popitem(last=False)
+        else:
+            sessions.move_to_end(session_id)
+        return history
+
+# Knowledge base context: per-snippet and total character budgets
+MAX_SNIPPET_CHARS = 600
+MAX_CONTEXT_CHARS = 1200
+
+# Streaming: batch token deltas into one SSE frame per 64 chars / 50 ms
+SSE_FLUSH_CHARS = 64
+SSE_FLUSH_SECONDS = 0.05
 
 @app.route('/')
 def index():
@@ -78,8 +209,7 @@ def health():
     }
     
     if knowledge_search.ix:
-        with knowledge_search.ix.searcher() as searcher:
-            kb_status['document_count'] = searcher.doc_count_all()
+        kb_status['document_count'] = knowledge_search.doc_count()
     
     return jsonify({
         'ok': True,
@@ -98,77 +228,85 @@ def chat():
         message = data.get('message', '').strip()
         session_id = data.get('session_id', 'default')
         
-        print(f"\n💬 Q: {message}")
+        logger.info("💬 Q: %s", message)
+        
+        history = get_session(session_id)
+        
+        key_match = HCT_URL_KEYS.search(message)
+        web_url = HCT_URLS[key_match.group(0).lower()] if key_match else None
         
-        if session_id not in sessions:
-            sessions[session_id] = []
+        # Knowledge base search and website scrape are independent -
+        # start both now so they overlap
+        search_future = io_pool.submit(knowledge_search.search, message, 3)
+        web_future = io_pool.submit(fetch_hct_page, web_url) if web_url else None
         
         # ==============================================================
         # Search Google Drive knowledge base FIRST (priority source)
         # ==============================================================
         local_context = ""
+        search_results = []
         
         try:
-            search_results = knowledge_search.search(message, max_results=3)
+            search_results = search_future.result(timeout=CONTEXT_TIMEOUT)
             
             if search_results:
-                print(f"📚 Found {len(search_results)} documents from Google Drive:")
+                logger.info("📚 Found %d documents from Google Drive", len(search_results))
                 
-                local_context = "\n\n=== FROM HCT KNOWLEDGE BASE (Google Drive) ===\n"
+                parts = ["\n\n=== FROM HCT KNOWLEDGE BASE (Google Drive) ===\n"]
+                budget = MAX_CONTEXT_CHARS
                 
+                # Results are best-first; stop once the context budget is spent
                 for i, result in enumerate(search_results[:2], 1):
-                    print(f"   [{i}] {result['filename']} (Score: {result['score']:.2f})")
-                    local_context += f"\n[Document {i}: {result['filename']}]\n"
-                    local_context += f"{result['snippet']}\n"
+                    if budget <= 0:
+                        break
+                    snippet = result['snippet'][:MAX_SNIPPET_CHARS][:budget].strip()
+                    if not snippet:
+                        continue
+                    budget -= len(snippet)
+                    
+                    logger.debug("   [%d] %s (Score: %.2f)", i, result['filename'], result['score'])
+                    parts.append(f"\n[Document {i}: {result['filename']}]\n{snippet}\n")
                 
-                local_context += "=== END KNOWLEDGE BASE ===\n"
+                parts.append("=== END KNOWLEDGE BASE ===\n")
+                local_context = ''.join(parts)
             else:
-                print("⚠️ No documents found in knowledge base")
+                logger.info("⚠️ No documents found in knowledge base")
         except Exception as e:
-            print(f"⚠️ Knowledge search error: {e}")
+            logger.warning("⚠️ Knowledge search error: %r", e)
             local_context = ""
         
         # ==============================================================
-        # ALSO check website for latest info
+        # ALSO check website for latest info - unless the knowledge base
+        # already has a strong match, which keeps the prompt short
         # ==============================================================
         web_context = ""
-        message_lower = message.lower()
         
-        for key, url in HCT_URLS.items():
-            if key in message_lower:
-                web_content = fetch_hct_page(url)
+        if web_future and search_results and search_results[0]['score'] >= WEB_SKIP_SCORE:
+            # Not waited on; the fetch finishes in the background and fills the cache
+            logger.debug("⏭️ Website content skipped for %s (top score %.2f)",
+                         web_url, search_results[0]['score'])
+        elif web_future:
+            try:
+                web_content = web_future.result(timeout=CONTEXT_TIMEOUT)
                 if web_content:
                     web_context = f"\n\n=== FROM WEBSITE (Latest) ===\n{web_content}\n=== END WEBSITE ===\n"
-                break
+            except Exception as e:
+                # A slow page still finishes in the background and fills the cache
+                logger.warning("⚠️ Website fetch skipped: %r", e)
         
         # ==============================================================
         # Build messages with conversational AI prompt
         # ==============================================================
         
-        system_prompt = f"""You are the HCT Voice Agent, a knowledgeable and conversational expert on Hazard Control Technologies products and fire suppression solutions.
-
-RESPONSE STYLE:
-- Provide comprehensive answers of 6-7 sentences that fully explain the topic
-- Be conversational and professional, never say "I don't have that in my knowledge base"
-- If you don't have specific information, provide related helpful information about HCT products and offer to help with related topics
-- Occasionally (about 30% of the time) ask a relevant follow-up question to engage the user, especially when:
-  * The user asks a broad question that could be narrowed down
-  * There are multiple product options that might fit their needs
-  * You want to understand their specific use case better
-- Don't ask follow-up questions when the user asks a very specific factual question that you fully answered
-
-KNOWLEDGE SOURCES (use these when available):
-{KNOWLEDGE}
-{local_context}
-{web_context}
-
-Remember: Be helpful, detailed, and conversational. Focus on providing value even if you don't have the exact information requested."""
+        system_prompt = ''.join((SYSTEM_PROMPT_HEAD, local_context, '\n', web_context, SYSTEM_PROMPT_TAIL))
         
+        # list() copies the deque in one step, so a concurrent turn on the same
+        # session appending to it can't break the copy (iterating it could)
         messages = [
-            {'role': 'system', 'content': system_prompt}
+            {'role': 'system', 'content': system_prompt},
+            *list(history)[-2:],
+            {'role': 'user', 'content': message},
         ]
-        messages.extend(sessions[session_id][-2:])
-        messages.append({'role': 'user', 'content': message})
         
         def generate():
             try:
@@ -176,37 +314,54 @@ Remember: Be helpful, detailed, and conversational. Focus on providing value eve
                     model='gpt-4o-mini',
                     messages=messages,
                     stream=True,
+                    stream_options={'include_usage': False},
                     max_tokens=400,  # Increased for longer responses
                     temperature=0.7  # Increased for more conversational tone
                 )
                 
-                full = ''
+                # Coalesce token deltas into fewer SSE frames: flush once the
+                # buffer holds SSE_FLUSH_CHARS or SSE_FLUSH_SECONDS have passed
+                parts = []
+                buf = []
+                buf_len = 0
+                last_flush = time.monotonic()
                 for chunk in stream:
                     if chunk.choices[0].delta.content:
                         content = chunk.choices[0].delta.content
-                        full += content
-                        yield f"data: {json.dumps({'content': content})}\n\n"
+                        parts.append(content)
+                        buf.append(content)
+                        buf_len += len(content)
+                        
+                        now = time.monotonic()
+                        if buf_len >= SSE_FLUSH_CHARS or now - last_flush >= SSE_FLUSH_SECONDS:
+                            yield b"data: " + orjson.dumps({'content': ''.join(buf)}) + b"\n\n"
+                            buf.clear()
+                            buf_len = 0
+                            last_flush = now
                 
-                print(f"✅ A: {full[:50]}...")
+                if buf:
+                    yield b"data: " + orjson.dumps({'content': ''.join(buf)}) + b"\n\n"
+                full = ''.join(parts)
                 
-                sessions[session_id].append({'role': 'user', 'content': message})
-                sessions[session_id].append({'role': 'assistant', 'content': full})
-                sessions[session_id] = sessions[session_id][-4:]
+                logger.info("✅ A: %s...", full[:50])
                 
-                yield f"data: [DONE]\n\n"
+                history.append({'role': 'user', 'content': message})
+                history.append({'role': 'assistant', 'content': full})
+                
+                yield b"data: [DONE]\n\n"
                 
             except Exception as e:
-                print(f"❌ Error: {e}")
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                logger.error("❌ Error: %s", e)
+                yield b"data: " + orjson.dumps({'error': str(e)}) + b"\n\n"
         
         return Response(generate(), mimetype='text/event-stream')
     
     except Exception as e:
-        print(f"❌ Error: {e}")
+        logger.error("❌ Error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # ============================================================================
-# TTS - HD Quality
+# TTS - streamed (tts-1, HD on request)
 # ============================================================================
 
 @app.route('/speak', methods=['POST'])
@@ -222,39 +377,48 @@ def speak():
         if len(text) > 500:
             text = text[:500]
         
-        print(f"🔊 TTS ({voice}): {len(text)} chars")
+        # tts-1 is markedly faster; HD is opt-in per request
+        model = 'tts-1-hd' if data.get('hd') else 'tts-1'
+        
+        logger.info("🔊 TTS (%s, %s): %d chars", voice, model, len(text))
         
-        response = client.audio.speech.create(
-            model='tts-1-hd',
+        # Open the upstream stream here so API errors still return a 500,
+        # then relay the MP3 bytes as they arrive
+        upstream = ExitStack()
+        response = upstream.enter_context(client.audio.speech.with_streaming_response.create(
+            model=model,
             voice=voice,
             input=text,
             speed=1.0,
             response_format='mp3'
-        )
-        
-        print("✅ TTS done")
+        ))
         
-        return send_file(
-            BytesIO(response.content),
-            mimetype='audio/mpeg',
-            as_attachment=False
-        )
+        audio = Response(response.iter_bytes(chunk_size=4096), mimetype='audio/mpeg')
+        audio.call_on_close(upstream.close)
+        return audio
     
     except Exception as e:
-        print(f"❌ TTS error: {e}")
+        logger.error("❌ TTS error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # ============================================================================
 # Knowledge Base API Endpoints
 # ============================================================================
 
+# Upper bound on max_results accepted by /knowledge/search
+MAX_SEARCH_RESULTS = 20
+
 @app.route('/knowledge/search', methods=['POST'])
 def search_knowledge():
     """Direct search endpoint for testing"""
     try:
         data = request.json
         query = data.get('query', '')
-        max_results = data.get('max_results', 5)
+        # Bounded int: it is part of the search cache key
+        try:
+            max_results = min(max(int(data.get('max_results', 5)), 1), MAX_SEARCH_RESULTS)
+        except (TypeError, ValueError):
+            max_results = 5
         
         results = knowledge_search.search(query, max_results)
         
@@ -272,15 +436,13 @@ def knowledge_stats():
     """Get stats about knowledge base"""
     try:
         if knowledge_search.ix:
-            with knowledge_search.ix.searcher() as searcher:
-                doc_count = searcher.doc_count_all()
-                return jsonify({
-                    'indexed': True,
-                    'document_count': doc_count,
-                    'index_path': knowledge_search.index_dir,
-                    'source': 'google_drive' if os.getenv('GOOGLE_DRIVE_FOLDER_ID') else 'local',
-                    'drive_folder': os.getenv('GOOGLE_DRIVE_FOLDER_ID', 'N/A')
-                })
+            return jsonify({
+                'indexed': True,
+                'document_count': knowledge_search.doc_count(),
+                'index_path': knowledge_search.index_dir,
+                'source': 'google_drive' if os.getenv('GOOGLE_DRIVE_FOLDER_ID') else 'local',
+                'drive_folder': os.getenv('GOOGLE_DRIVE_FOLDER_ID', 'N/A')
+            })
         else:
             return jsonify({
                 'indexed': False,
@@ -306,23 +468,27 @@ def refresh_knowledge():
         scanner = GoogleDriveScanner()
         documents = scanner.scan_drive()
         
-        if documents:
-            scanner.save_index(documents)
-            
-            # Rebuild search index
-            knowledge_search.create_index(documents)
-            
-            return jsonify({
-                'success': True,
-                'documents_scanned': len(documents),
-                'total_words': sum(d['word_count'] for d in documents),
-                'message': 'Knowledge base refreshed from Google Drive'
-            })
-        else:
+        # Peek first so an empty scan never replaces the live index
+        first = next(documents, None)
+        if first is None:
             return jsonify({
                 'success': False,
                 'message': 'No documents found in Google Drive'
             }), 404
+        
+        # Rebuild search index, streaming documents in as they're extracted
+        stats = knowledge_search.create_index(itertools.chain([first], documents))
+        
+        # Refresh means fresh website content too
+        with page_cache_lock:
+            page_cache.clear()
+        
+        return jsonify({
+            'success': True,
+            'documents_scanned': stats['total_documents'],
+            'total_words': stats['total_words'],
+            'message': 'Knowledge base refreshed from Google Drive'
+        })
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -351,7 +517,7 @@ if __name__ == '__main__':
             print("   Run: python update_knowledge.py")
     
     print("✅ Server: http://localhost:5002")
-    print("✅ HD Audio (tts-1-hd)")
+    print("✅ Streaming audio (tts-1, HD opt-in)")
     print("✅ LangChain universal document parsing")
     print("✅ API endpoint: POST /knowledge/refresh (trigger Drive sync)")
     print("="*60 + "\n")
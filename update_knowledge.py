@@ -11,7 +11,7 @@ from knowledge_search import KnowledgeSearch
 # Default KB path
 KB_PATH = '/Users/omkarkapade/Desktop/HCT AI Agent-KB'
 
-def update_knowledge_base(kb_path=KB_PATH):
+def update_knowledge_base(kb_path=KB_PATH, dump_json=False):
     """
     Full update: Scan documents + rebuild search index
     """
@@ -28,36 +28,41 @@ def update_knowledge_base(kb_path=KB_PATH):
         print("\n❌ No documents found!")
         return False
     
-    # Step 2: Save JSON index
-    print("\n💾 Step 2: Saving document index...")
-    scanner.save_index(documents, 'knowledge_index.json')
+    # Step 2: Save JSON index (only on request - the search index
+    # below is built straight from the scanned documents)
+    if dump_json:
+        print("\n💾 Step 2: Saving document index...")
+        scanner.save_index(documents, 'knowledge_index.json')
     
     # Step 3: Build search index
     print("\n🔨 Step 3: Building search index...")
-    search = KnowledgeSearch('whoosh_index')
-    search.create_index(documents)
+    search = KnowledgeSearch('search_index')
+    stats = search.create_index(documents)
     
     print("\n" + "="*70)
     print("✅ KNOWLEDGE BASE UPDATED!")
     print("="*70)
-    print(f"📊 Total documents: {len(documents)}")
-    print(f"📊 Total words: {sum(d['word_count'] for d in documents):,}")
+    print(f"📊 Total documents: {stats['total_documents']}")
+    print(f"📊 Total words: {stats['total_words']:,}")
     print("\n💡 Ready to use in voice agent!")
     print("="*70 + "\n")
     
     return True
 
 if __name__ == '__main__':
-    # Allow custom path from command line
-    kb_path = sys.argv[1] if len(sys.argv) > 1 else KB_PATH
+    # Allow custom path from command line; --dump-json also writes knowledge_index.json
+    args = sys.argv[1:]
+    dump_json = '--dump-json' in args
+    args = [arg for arg in args if arg != '--dump-json']
+    kb_path = args[0] if args else KB_PATH
     
     # Check if path exists
     if not os.path.exists(kb_path):
         print(f"\n❌ Folder not found: {kb_path}")
-        print(f"\n💡 Usage: python update_knowledge.py [path-to-kb-folder]")
+        print(f"\n💡 Usage: python update_knowledge.py [path-to-kb-folder] [--dump-json]")
         print(f"   Default: {KB_PATH}\n")
         sys.exit(1)
     
     # Run update
-    success = update_knowledge_base(kb_path)
+    success = update_knowledge_base(kb_path, dump_json)
     sys.exit(0 if success else 1)
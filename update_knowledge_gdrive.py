@@ -4,10 +4,11 @@ Update HCT Knowledge Base from Google Drive
 """
 import sys
 import os
+import itertools
 from gdrive_document_scanner import GoogleDriveScanner
 from knowledge_search import KnowledgeSearch
 
-def update_knowledge_base():
+def update_knowledge_base(dump_json=False):
     print("\n" + "="*70)
     print("🔄 UPDATING HCT KNOWLEDGE BASE FROM GOOGLE DRIVE")
     print("="*70)
@@ -22,29 +23,37 @@ def update_knowledge_base():
     scanner = GoogleDriveScanner()
     documents = scanner.scan_drive()
     
-    if not documents:
+    # Documents stream straight into the index; peek first so an empty
+    # scan doesn't replace the existing index with nothing
+    first = next(documents, None)
+    if first is None:
         print("\n❌ No documents found in Google Drive!")
         return False
+    documents = itertools.chain([first], documents)
     
-    # Step 2: Save JSON index
-    print("\n💾 Step 2: Saving document index...")
-    scanner.save_index(documents, 'knowledge_index.json')
+    # Step 2: Save JSON index (only on request - the search index
+    # below is built straight from the scanned documents)
+    if dump_json:
+        print("\n💾 Step 2: Saving document index...")
+        documents = list(documents)
+        scanner.save_index(documents, 'knowledge_index.json')
     
     # Step 3: Build search index
     print("\n🔨 Step 3: Building search index...")
-    search = KnowledgeSearch('whoosh_index')
-    search.create_index(documents)
+    search = KnowledgeSearch('search_index')
+    stats = search.create_index(documents)
     
     print("\n" + "="*70)
     print("✅ KNOWLEDGE BASE UPDATED!")
     print("="*70)
-    print(f"📊 Total documents: {len(documents)}")
-    print(f"📊 Total words: {sum(d['word_count'] for d in documents):,}")
+    print(f"📊 Total documents: {stats['total_documents']}")
+    print(f"📊 Total words: {stats['total_words']:,}")
     print("\n💡 Ready to use in voice agent!")
     print("="*70 + "\n")
     
     return True
 
 if __name__ == '__main__':
-    success = update_knowledge_base()
+    # --dump-json also writes knowledge_index.json
+    success = update_knowledge_base('--dump-json' in sys.argv[1:])
     sys.exit(0 if success else 1)
\ No newline at end of file